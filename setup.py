@@ -55,6 +55,9 @@ setup(
             ]
         },
     install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard >=0.15'],
+        },
     license="BSD (3-clause)",
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
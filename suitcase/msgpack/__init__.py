@@ -3,10 +3,20 @@
 # intended to be user-facing. They should accept the parameters sketched here,
 # but may also accpet additional required or optional keyword arguments, as
 # needed.
+import concurrent.futures
 import event_model
+import functools
+import io
 import msgpack
+import mmap
 import msgpack_numpy
+import numpy as np
+import os
 from pathlib import Path
+import queue
+import string
+import threading
+from types import MappingProxyType
 import suitcase.utils
 from ._version import get_versions
 
@@ -55,9 +65,9 @@ def export(gen, directory, file_prefix='{start[uid]}', **kwargs):
 
     Returns
     -------
-    artifacts : dict
-        dict mapping the 'labels' to lists of file names (or, in general,
-        whatever resources are produced by the Manager)
+    artifacts : mapping
+        read-only mapping of the 'labels' to lists of file names (or, in
+        general, whatever resources are produced by the Manager)
 
     Examples
     --------
@@ -118,27 +128,159 @@ class Serializer(event_model.DocumentRouter):
         descriptive value depends on the application and is therefore left to
         the user.
 
-    flush : boolean
+    flush : boolean or 'boundary'
         Flush the file to disk after each document. As a consequence, writing
         the full document stream is slower but each document is immediately
-        available for reading. False by default.
+        available for reading. With ``'boundary'``, flush after every document
+        except EventPages: the structure of the run is promptly available for
+        reading, but high-rate streams of pages are still written in bulk.
+        False by default.
+
+    buffer_size : int, optional
+        Size in bytes of the write buffer placed in front of each file. Many
+        small documents are coalesced into one write to the operating system.
+        1 MiB by default.
+
+    batch_size : int, optional
+        Number of consecutive EventPages (or DatumPages) of the same stream to
+        merge into a single page before writing it. Held pages are written as
+        soon as the batch is full or any other document arrives, so the order
+        of documents is preserved. 1 (no merging) by default.
+
+    workers : int, optional
+        Number of threads used to make C-contiguous copies of large arrays
+        when an EventPage holds several that are not contiguous already
+        (e.g. slices or transposes). None (no threads) by default.
+
+    compression : {None, 'zstd'}, optional
+        Compress the output as a zstandard stream, using all available cores.
+        The file name then ends in ``.msgpack.zst`` rather than ``.msgpack``.
+        This requires the ``zstandard`` package (0.15 or newer), which is
+        installed with the ``zstd`` extra. None (no compression) by default.
+
+    compression_level : int, optional
+        The zstandard compression level. 3 by default.
+
+    dtype_downcast : dict, optional
+        Store float64 arrays in EventPages at lower precision. This maps data
+        keys to a float dtype smaller than float64, such as ``'float32'`` or
+        ``'float16'``. The key ``'default'`` applies to every other data key,
+        and a value of None keeps a data key at full precision. Only
+        array-valued data keys (with a non-empty shape) whose
+        EventDescriptor declares ``'dtype_numpy'`` as float64 are converted;
+        scalars are left as they are. In the EventDescriptor, each converted
+        data key gets the new ``'dtype_numpy'`` and is marked with a
+        ``'dtype_downcast'`` entry so that readers can tell precision was
+        lost. None (full precision) by default.
+
+    direct_io : boolean, optional
+        Open files with ``O_DIRECT`` (Linux only), bypassing the operating
+        system's page cache. This can help when exporting large runs to fast
+        storage. Data is written in whole 4 KiB blocks, so flushing writes
+        only the complete blocks; the rest is written when the file is
+        closed. Only valid when ``directory`` is a path. False by default.
+
+    async_writes : boolean, optional
+        Encode documents on the calling thread but write them to the file on
+        a background thread, so the caller does not wait on slow (e.g.
+        network) storage. Documents are written in order. Arrays are written
+        from their own memory, so they must not be modified after they are
+        passed in. An error raised while writing is raised again from the
+        next document or from ``close()``. False by default.
 
     **kwargs : kwargs
-        Keyword arugments to be passed through to the underlying I/O library.
+        Keyword arugments to be passed through to the underlying I/O library,
+        ``msgpack.Packer``. Its ``autoreset`` argument is reserved for use by
+        the Serializer and is ignored.
 
     Attributes
     ----------
     artifacts
-        dict mapping the 'labels' to lists of file names (or, in general,
-        whatever resources are produced by the Manager)
+        read-only mapping of the 'labels' to lists of file names (or, in
+        general, whatever resources are produced by the Manager)
     """
     def __init__(self, directory, file_prefix='{start[uid]}', flush=False,
-                 **kwargs):
+                 buffer_size=1 << 20, batch_size=1, workers=None,
+                 compression=None, compression_level=3, dtype_downcast=None,
+                 direct_io=False, async_writes=False, **kwargs):
 
         self._file_prefix = file_prefix
-        self._flush = flush
-        self._kwargs = kwargs
+        if flush == 'boundary':
+            self._flush_after = _BOUNDARY_NAMES
+        elif isinstance(flush, str):
+            raise ValueError(
+                f"flush must be True, False or 'boundary', not {flush!r}")
+        elif flush:
+            self._flush_after = frozenset(('start',) + _NAMES)
+        else:
+            self._flush_after = frozenset()
+        self._buffer_size = buffer_size
+        self._batch_size = batch_size
+        self._pending = []  # pages held back to be merged
+        self._pending_key = None  # (name, descriptor or resource uid)
+        if compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError as err:
+                raise ImportError(
+                    "compression='zstd' requires the zstandard package; "
+                    "install it with `pip install suitcase-msgpack[zstd]`"
+                ) from err
+            version = tuple(int(part) for part in
+                            zstandard.__version__.split('.')[:2])
+            if version < _MIN_ZSTANDARD_VERSION:
+                raise ImportError(
+                    f"compression='zstd' requires zstandard >= "
+                    f"{'.'.join(map(str, _MIN_ZSTANDARD_VERSION))}, not "
+                    f"{zstandard.__version__}")
+            self._compressor = zstandard.ZstdCompressor(
+                level=compression_level, threads=-1)
+        elif compression is None:
+            self._compressor = None
+        else:
+            raise ValueError(
+                f"compression must be None or 'zstd', not {compression!r}")
+        self._downcast = {}
+        for key, dtype in (dtype_downcast or {}).items():
+            if dtype is not None:
+                dtype = np.dtype(dtype)
+                if dtype.kind != 'f' or dtype.itemsize >= 8:
+                    raise ValueError(
+                        f"dtype_downcast must map to float dtypes smaller "
+                        f"than float64, not {dtype} (for {key!r})")
+            self._downcast[key] = dtype
+        self._downcast_default = self._downcast.pop('default', None)
+        self._downcasting = bool(self._downcast) or (
+            self._downcast_default is not None)
+        if workers:
+            self._pool = concurrent.futures.ThreadPoolExecutor(workers)
+        else:
+            self._pool = None
+        kwargs.pop('autoreset', None)  # reserved; see below
+        # One Packer is reused for every document. With autoreset=False it
+        # keeps its internal buffer, which we hand to the file without making
+        # an intermediate bytes object.
+        # See https://github.com/msgpack/msgpack-python#string-and-binary-type
+        # for more on use_bin_type.
+        packer_kwargs = {'default': msgpack_numpy.encode, 'use_bin_type': True,
+                         **kwargs}
+        self._packer = msgpack.Packer(**packer_kwargs, autoreset=False)
+        # Large arrays in EventPages can be written around the Packer only if
+        # they would otherwise be encoded by msgpack_numpy as bin data.
+        self._split_arrays = (
+            packer_kwargs['default'] is msgpack_numpy.encode and
+            packer_kwargs['use_bin_type'])
         self._templated_file_prefix = ''  # set when we get a 'start' document
+        if '{' in file_prefix or '}' in file_prefix:
+            parsed = list(_FORMATTER.parse(file_prefix))
+            if any('{' in (spec or '') for _, _, spec, _ in parsed):
+                # Nested fields inside a format spec: leave it to str.format.
+                self._render_prefix = file_prefix.format
+            else:
+                self._render_prefix = functools.partial(_fill_prefix, parsed)
+        else:
+            # There is nothing to fill in, so skip str.format.
+            self._render_prefix = lambda start: file_prefix
 
         if isinstance(directory, (str, Path)):
             # The user has given us a filepath; they want files.
@@ -147,13 +289,27 @@ class Serializer(event_model.DocumentRouter):
         else:
             # The user has given us their own Manager instance. Use that.
             self._manager = directory
-
-        self._buffer = None
+            if direct_io:
+                raise ValueError(
+                    "direct_io requires directory to be a path, not a Manager")
+        if direct_io and not hasattr(os, 'O_DIRECT'):
+            raise ValueError("direct_io is not supported on this platform")
+        self._direct_io = direct_io
+
+        self._file = None
+        self._buffer = None  # the file, or a compressor writing to it
+        self._fileno = None  # set if we can write to the file with writev
+        self._copies_on_write = False  # set if the buffer copies what it gets
+        self._array_keys = {}  # maps descriptor uid to array-valued data keys
+        self._downcast_keys = {}  # maps descriptor uid to {data key: dtype}
         self._closed = False
+        self._async_writes = async_writes
+        self._queue = None  # set, with the writer thread, when the file opens
+        self._writer = None
 
     @property
     def artifacts(self):
-        return self._manager.artifacts
+        return MappingProxyType(self._manager.artifacts)
 
     def close(self):
         """
@@ -161,7 +317,260 @@ class Serializer(event_model.DocumentRouter):
         """
         if not self._closed:
             self._closed = True
-            self._manager.close()
+            try:
+                if self._buffer is not None:
+                    self._write_pending()
+            finally:
+                if self._writer is not None:
+                    self._queue.put(None)
+                    self._writer.join()
+                if self._buffer is not None:
+                    if self._buffer is not self._file:
+                        # End the compressed stream. This leaves the file
+                        # open.
+                        self._buffer.close()
+                    self._file.flush()
+                    if isinstance(self._file, _DirectFile):
+                        # We opened this file, not the Manager.
+                        self._file.close()
+                if self._pool is not None:
+                    self._pool.shutdown()
+                self._manager.close()
+            if self._writer is not None and self._write_error is not None:
+                raise self._write_error
+
+    def _run(self, func, *args):
+        "Call func to write or flush, now or on the writer thread."
+        if self._queue is None:
+            func(*args)
+            return
+        if self._write_error is not None:
+            raise self._write_error
+        self._queue.put((func, args))
+
+    def _drain(self):
+        "Make the queued calls, in order. This runs on the writer thread."
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._write_error is None:
+                func, args = item
+                try:
+                    func(*args)
+                except BaseException as error:
+                    # Discard the rest; the caller will see this error.
+                    self._write_error = error
+
+    def _write(self, name, doc):
+        "Encode a (name, doc) pair and write it to the buffer."
+        packer = self._packer
+        try:
+            if name == 'event_page' and self._downcasting:
+                doc = self._downcast_page(doc)
+            if name == 'event_page' and self._split_arrays:
+                parts = self._pack_event_page(doc)
+            else:
+                parts = []
+                packer.pack((name, doc))
+            if parts:
+                parts.append(packer.bytes())
+                self._run(self._write_parts, self._array_views(parts))
+            elif self._queue is not None or not self._copies_on_write:
+                # The Packer's buffer is reused, so the writer thread, or a
+                # handle that may keep what it is given, gets a copy.
+                self._run(self._buffer.write, packer.bytes())
+            else:
+                with packer.getbuffer() as view:
+                    self._buffer.write(view)
+        finally:
+            packer.reset()
+
+    def _pack_event_page(self, doc):
+        """
+        Pack an EventPage, setting aside any large arrays in its data.
+
+        Returns the buffers that must be written ahead of whatever is left in
+        the Packer. Large arrays appear in that list as they are; their bytes
+        are never copied into the Packer.
+        """
+        packer = self._packer
+        pack = packer.pack
+        data = doc['data']
+        # Only keys that the descriptor declares with a shape can hold arrays.
+        keys = self._array_keys.get(doc['descriptor'])
+        columns = data.values() if keys is None else map(data.get, keys)
+        if not any(map(_holds_large_array, columns)):
+            # The common case: pack the whole page in one call.
+            pack(('event_page', doc))
+            return []
+        parts = []
+        packer.pack_array_header(2)
+        pack('event_page')
+        packer.pack_map_header(len(doc))
+        for key, value in doc.items():
+            pack(key)
+            if key == 'data':
+                packer.pack_map_header(len(value))
+                for data_key, column in value.items():
+                    pack(data_key)
+                    if isinstance(column, list) and _holds_large_array(column):
+                        packer.pack_array_header(len(column))
+                        for array in column:
+                            self._pack_array(array, parts)
+                    else:
+                        self._pack_array(column, parts)
+            else:
+                pack(value)
+        return parts
+
+    def _pack_array(self, array, parts):
+        "Pack a value, setting it aside if it is a large array."
+        packer = self._packer
+        if not _is_large_array(array):
+            packer.pack(array)
+            return
+        # This is the map made by msgpack_numpy.encode, but the header of the
+        # bin holding the array's bytes is written by hand.
+        packer.pack_map_header(5)
+        for item in (b'nd', True, b'type', array.dtype.str, b'kind', b'',
+                     b'shape', array.shape, b'data'):
+            packer.pack(item)
+        parts.append(packer.bytes())
+        packer.reset()
+        parts.append(b'\xc6' + array.nbytes.to_bytes(4, 'big'))
+        parts.append(array)
+
+    def _array_views(self, parts):
+        "Replace the arrays among parts with views of their bytes, in place."
+        indexes = [i for i, part in enumerate(parts)
+                   if isinstance(part, np.ndarray)]
+        arrays = [parts[i] for i in indexes]
+        copies = sum(not array.flags.c_contiguous for array in arrays)
+        if self._pool is not None and copies >= _MIN_PARALLEL_COPIES:
+            # numpy releases the GIL while it copies, so the copies overlap.
+            views = self._pool.map(_array_bytes, arrays)
+        else:
+            views = map(_array_bytes, arrays)
+        for i, view in zip(indexes, views):
+            parts[i] = view
+        return parts
+
+    def _write_parts(self, parts):
+        "Write buffers in order, with one os.writev call where possible."
+        if self._fileno is None:
+            # Large arrays are handed over in chunks, which bounds the memory
+            # that a compressor or other custom buffer needs for each write.
+            for part in parts:
+                view = memoryview(part)
+                for start in range(0, view.nbytes, _CHUNK_SIZE):
+                    self._buffer.write(view[start:start + _CHUNK_SIZE])
+        else:
+            # Anything still in the buffer must reach the file first.
+            self._buffer.flush()
+            _writev(self._fileno, parts)
+
+    def write_raw(self, name, raw):
+        """
+        Write a document that has already been encoded as msgpack.
+
+        This spares a decode and re-encode when documents arrive in msgpack
+        form, e.g. from a message bus. The bytes are written as they are, so
+        batching and dtype_downcast do not apply to them.
+
+        Parameters
+        ----------
+        name : string
+            The type of document, as in ``serializer(name, doc)``
+        raw : bytes-like
+            The pair ``(name, doc)`` encoded as msgpack, in the same form
+            that this Serializer writes. RunStart documents are decoded to
+            fill in the file_prefix.
+        """
+        if name == 'start':
+            _, doc = msgpack.unpackb(raw, object_hook=msgpack_numpy.decode,
+                                     raw=False)
+            self._open(doc)
+        else:
+            self._write_pending()
+        if self._queue is not None:
+            raw = bytes(raw)  # in case the caller reuses its buffer
+        self._run(self._buffer.write, raw)
+        if name == 'stop':
+            self.close()
+        elif name in self._flush_after:
+            self._run(self._buffer.flush)
+
+    def _downcast_dtype(self, key):
+        return self._downcast.get(key, self._downcast_default)
+
+    def _downcast_page(self, doc):
+        "Return a copy of an EventPage with float64 arrays downcast."
+        targets = self._downcast_keys.get(doc['descriptor'])
+        if not targets:
+            return doc
+        data = dict(doc['data'])
+        for key, dtype in targets.items():
+            if key in data:
+                data[key] = _downcast(data[key], dtype)
+        return {**doc, 'data': data}
+
+    def _mark_downcast(self, doc):
+        "Return a copy of an EventDescriptor noting which keys are downcast."
+        targets = {}
+        data_keys = {}
+        for key, data_key in doc['data_keys'].items():
+            dtype = self._downcast_dtype(key)
+            if (dtype is not None and data_key.get('shape') and
+                    _is_float64(data_key)):
+                targets[key] = dtype
+                data_key = {**data_key, 'dtype_numpy': dtype.str,
+                            'dtype_downcast': dtype.name}
+            data_keys[key] = data_key
+        self._downcast_keys[doc['uid']] = targets
+        return {**doc, 'data_keys': data_keys}
+
+    def _write_named(self, name, doc):
+        "Write any document other than a RunStart or RunStop."
+        if name in _MERGE:
+            self._write_page(name, doc)
+        else:
+            self._write_pending()
+            if name == 'descriptor':
+                self._array_keys[doc['uid']] = tuple(
+                    key for key, data_key in doc['data_keys'].items()
+                    if data_key.get('shape'))
+                if self._downcasting:
+                    doc = self._mark_downcast(doc)
+            self._write(name, doc)
+        if name in self._flush_after:
+            self._run(self._buffer.flush)
+
+    def _write_page(self, name, doc):
+        "Write a page, or hold it to be merged with the pages that follow."
+        merge, stream, keys = _MERGE[name]
+        if self._batch_size <= 1 or doc.keys() != keys:
+            # Merged pages have exactly these keys, so pages with any others
+            # (or without some, e.g. 'filled') are written as they are.
+            self._write_pending()
+            self._write(name, doc)
+            return
+        key = (name, doc[stream])
+        if key != self._pending_key:
+            self._write_pending()
+            self._pending_key = key
+        self._pending.append(doc)
+        if len(self._pending) >= self._batch_size:
+            self._write_pending()
+
+    def _write_pending(self):
+        "Merge any held pages into one and write it."
+        if self._pending:
+            name, _ = self._pending_key
+            merge, _, _ = _MERGE[name]
+            self._write(name, merge(self._pending))
+            self._pending = []
+        self._pending_key = None
 
     def __enter__(self):
         return self
@@ -170,27 +579,64 @@ class Serializer(event_model.DocumentRouter):
         self.close()
 
     def start(self, doc):
+        self._open(doc)
+        self._write('start', doc)
+        if 'start' in self._flush_after:
+            self._run(self._buffer.flush)
+
+    def _open(self, doc):
+        "Open the file for the run that begins with this RunStart document."
         # Fill in the file_prefix with the contents of the RunStart document.
         # As in, '{tart[uid]}' -> 'c1790369-e4b2-46c7-a294-7abfa239691a'
         # or 'my-data-from-{plan-name}' -> 'my-data-from-scan'
-        filename = f'{self._file_prefix.format(start=doc)}.msgpack'
-        self._buffer = self._manager.open('all', filename, 'xb')
-        self._buffer.write(_encode(('start', doc), **self._kwargs))
-        if self._flush:
-            self._buffer.flush()
+        filename = f'{self._render_prefix(start=doc)}.msgpack'
+        if self._compressor is not None:
+            filename += '.zst'
+        if self._direct_io:
+            path = self._manager.reserve_name('all', filename)
+            os.makedirs(path.parent, exist_ok=True)
+            self._file = _DirectFile(path, self._buffer_size)
+        else:
+            self._file = _rebuffer(self._manager.open('all', filename, 'xb'),
+                                   self._buffer_size)
+        # Only handles known to copy what they are given may be handed a view
+        # of the Packer's buffer, which is released once write() returns.
+        self._copies_on_write = (
+            self._compressor is not None or
+            type(self._file) in (io.BufferedWriter, io.BytesIO, _DirectFile))
+        if self._async_writes:
+            # Writes, and the flushes between them, are queued for a single
+            # writer thread, which keeps them in order. It is started here,
+            # not in __init__, so that a Serializer that never gets a
+            # RunStart does not leave a thread behind holding on to it.
+            self._queue = queue.Queue(maxsize=_QUEUE_SIZE)
+            self._write_error = None
+            self._writer = threading.Thread(target=self._drain, daemon=True)
+            self._writer.start()
+        if self._compressor is not None:
+            self._buffer = self._compressor.stream_writer(self._file,
+                                                          closefd=False)
+        else:
+            self._buffer = self._file
+            if (isinstance(self._file, io.BufferedWriter) and
+                    hasattr(os, 'writev')):
+                # We put this buffer in front of the file, so large arrays
+                # may be written around it, straight to the file, if it has a
+                # file descriptor.
+                try:
+                    self._fileno = self._file.fileno()
+                except (OSError, io.UnsupportedOperation):
+                    pass
 
     def descriptor(self, doc):
-        self._buffer.write(_encode(('descriptor', doc), **self._kwargs))
-        if self._flush:
-            self._buffer.flush()
+        self._write_named('descriptor', doc)
 
     def event_page(self, doc):
-        self._buffer.write(_encode(('event_page', doc), **self._kwargs))
-        if self._flush:
-            self._buffer.flush()
+        self._write_named('event_page', doc)
 
     def stop(self, doc):
-        self._buffer.write(_encode(('stop', doc), **self._kwargs))
+        self._write_pending()
+        self._write('stop', doc)
         self.close()
 
     # This suitcase can be used to store "unfilled" Events, Events that
@@ -198,19 +644,200 @@ class Serializer(event_model.DocumentRouter):
     # Not all suitcases do this.
 
     def datum_page(self, doc):
-        self._buffer.write(_encode(('datum_page', doc), **self._kwargs))
-        if self._flush:
-            self._buffer.flush()
+        self._write_named('datum_page', doc)
 
     def resource(self, doc):
-        self._buffer.write(_encode(('resource', doc), **self._kwargs))
-        if self._flush:
-            self._buffer.flush()
+        self._write_named('resource', doc)
+
+
+_FORMATTER = string.Formatter()
+_NAMES = ('descriptor', 'event_page', 'datum_page', 'resource')
+# Documents after which flush='boundary' flushes (RunStop always closes)
+_BOUNDARY_NAMES = frozenset(('start', 'descriptor', 'datum_page', 'resource'))
+# For each kind of page: how to merge pages, the key naming their stream, and
+# the keys that pages must have (no more, no fewer) to be merged
+_MERGE = {
+    'event_page': (event_model.merge_event_pages, 'descriptor',
+                   frozenset(('descriptor', 'seq_num', 'time', 'uid', 'data',
+                              'timestamps', 'filled'))),
+    'datum_page': (event_model.merge_datum_pages, 'resource',
+                   frozenset(('resource', 'datum_id', 'datum_kwargs')))}
+
+# Arrays at least this large are written from their own memory rather than
+# being copied into the Packer. A bin32 header limits them to 4 GiB.
+_LARGE_ARRAY_NBYTES = 1 << 20
+_MAX_BIN_NBYTES = 1 << 32
+# Size of the pieces in which large arrays are written to buffers that are not
+# plain files
+_CHUNK_SIZE = 1 << 18
+# O_DIRECT writes are made in multiples of this many bytes.
+_DIRECT_BLOCK_SIZE = 4096
+# The first zstandard whose stream_writer accepts closefd
+_MIN_ZSTANDARD_VERSION = (0, 15)
+# Documents that may wait for the writer thread before the caller is held up
+_QUEUE_SIZE = 128
+# Fewer copies than this are not worth handing to the thread pool.
+_MIN_PARALLEL_COPIES = 2
+# Most platforms accept at least this many buffers in one writev call.
+_IOV_MAX = 1024
+
+
+class _DirectFile(io.RawIOBase):
+    """
+    A new file, opened for writing with O_DIRECT.
 
+    O_DIRECT requires whole blocks to be written from aligned memory, so data
+    is gathered in a page-aligned (anonymous mmap) buffer and written out a
+    block at a time. On close, the last partial block is padded, written, and
+    then truncated away.
+    """
+    def __init__(self, path, buffer_size):
+        self._fd = None  # None once the file is closed, or if opening fails
+        size = max(buffer_size - buffer_size % _DIRECT_BLOCK_SIZE,
+                   _DIRECT_BLOCK_SIZE)
+        fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_DIRECT, 0o666)
+        try:
+            self._mmap = mmap.mmap(-1, size)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        self._view = memoryview(self._mmap)
+        self._length = 0  # bytes waiting in the buffer
+        self._size = 0  # bytes written to the file
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        count = data.nbytes
+        while data:
+            n = min(data.nbytes, len(self._view) - self._length)
+            self._view[self._length:self._length + n] = data[:n]
+            self._length += n
+            data = data[n:]
+            if self._length == len(self._view):
+                self._write_blocks()
+        return count
+
+    def _write_blocks(self):
+        "Write every whole block in the buffer to the file."
+        end = self._length - self._length % _DIRECT_BLOCK_SIZE
+        written = 0
+        while written < end:
+            # Release the slice even if the write fails, so that the mmap
+            # can still be closed.
+            with self._view[written:end] as blocks:
+                written += os.write(self._fd, blocks)
+        self._size += end
+        self._length -= end
+        self._view[:self._length] = self._view[end:end + self._length]
+
+    def flush(self):
+        if self._fd is not None:
+            self._write_blocks()
 
-def _encode(obj, default=msgpack_numpy.encode, use_bin_type=True, **kwargs):
-    "Encode as msgpack using numpy-aware encoder."
-    # See https://github.com/msgpack/msgpack-python#string-and-binary-type
-    # for more on use_bin_type.
-    return msgpack.packb(obj, default=default, use_bin_type=use_bin_type,
-                         **kwargs)
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._fd is not None:
+                try:
+                    size = self._size + self._length
+                    padding = -self._length % _DIRECT_BLOCK_SIZE
+                    self._view[self._length:self._length + padding] = bytes(
+                        padding)
+                    self._length += padding
+                    self._write_blocks()
+                    os.ftruncate(self._fd, size)
+                finally:
+                    # Release these even if the last writes failed. With
+                    # self._fd unset, flush() has nothing left to write.
+                    fd, self._fd = self._fd, None
+                    try:
+                        self._view.release()
+                        self._mmap.close()
+                    finally:
+                        os.close(fd)
+        finally:
+            super().close()
+
+
+def _rebuffer(handle, buffer_size):
+    "Put a buffer of the given size in front of a binary file handle."
+    if isinstance(handle, io.BufferedWriter):
+        # Replace the default (small) buffer rather than stacking a second
+        # buffer on top of it. The Manager still owns the original handle and
+        # closes the underlying file.
+        handle = handle.raw
+    if isinstance(handle, io.RawIOBase):
+        return io.BufferedWriter(handle, buffer_size=buffer_size)
+    # In-memory buffers and other custom handles are used as they are.
+    return handle
+
+
+def _array_bytes(array):
+    "Return a flat byte view of an array, copying only if not C-contiguous."
+    return np.ascontiguousarray(array).reshape(-1).view(np.uint8).data
+
+
+def _is_large_array(obj):
+    return (isinstance(obj, np.ndarray) and obj.dtype.kind not in ('V', 'O')
+            and _LARGE_ARRAY_NBYTES <= obj.nbytes < _MAX_BIN_NBYTES)
+
+
+def _holds_large_array(value):
+    "Is this a large array, or a list that starts with one?"
+    if type(value) is list:
+        return bool(value) and _is_large_array(value[0])
+    return _is_large_array(value)
+
+
+def _fill_prefix(parsed, start):
+    """
+    Fill in a file_prefix that has been parsed by string.Formatter.
+
+    This gives the same result as ``file_prefix.format(start=start)`` without
+    parsing the template again for every run.
+    """
+    pieces = []
+    for literal, field_name, format_spec, conversion in parsed:
+        pieces.append(literal)
+        if field_name is not None:
+            obj, _ = _FORMATTER.get_field(field_name, (), {'start': start})
+            obj = _FORMATTER.convert_field(obj, conversion)
+            pieces.append(format(obj, format_spec))
+    return ''.join(pieces)
+
+
+def _is_float64(data_key):
+    "Whether a data key declares that its values are float64."
+    dtype_numpy = data_key.get('dtype_numpy')
+    if dtype_numpy is None:
+        return False
+    try:
+        return np.dtype(dtype_numpy) == np.float64
+    except (TypeError, ValueError):
+        return False
+
+
+def _downcast(value, dtype):
+    "Convert a float64 array, or those in a list, to dtype; leave the rest."
+    if type(value) is list:
+        return [_downcast(item, dtype) for item in value]
+    if isinstance(value, np.ndarray) and value.dtype == np.float64:
+        return value.astype(dtype)
+    return value
+
+
+def _writev(fileno, parts):
+    "Write all of the buffers with os.writev, resuming after short writes."
+    views = [memoryview(part) for part in parts]
+    while views:
+        written = os.writev(fileno, views[:_IOV_MAX])
+        while views and written >= views[0].nbytes:
+            written -= views.pop(0).nbytes
+        if written:
+            views[0] = views[0][written:]
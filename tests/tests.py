@@ -1,7 +1,61 @@
 # Tests should generate (and then clean up) any files they need for testing. No
 # binary files should be included in the repository.
 
-from suitcase.msgpack import export
+import event_model
+import gc
+import io
+import itertools
+import json
+import mmap
+import msgpack
+import msgpack_numpy
+import numpy as np
+import os
+import pytest
+import sys
+import threading
+import suitcase.msgpack
+import suitcase.utils
+import types
+import weakref
+from event_model import NumpyEncoder
+from suitcase.msgpack import export, Serializer
+
+
+def _read(filepath):
+    "Read back the (name, doc) pairs written to a msgpack file."
+    with open(filepath, 'rb') as file:
+        unpacker = msgpack.Unpacker(file, object_hook=msgpack_numpy.decode,
+                                    raw=False)
+        return [tuple(item) for item in unpacker]
+
+
+def _normalize(documents):
+    "Make documents comparable by unpacking pages into single Events."
+    unpacked = []
+    for name, doc in documents:
+        if name == 'event_page':
+            events = event_model.unpack_event_page(doc)
+        elif name == 'bulk_events':
+            events = [event for events in doc.values() for event in events]
+        elif name == 'event':
+            events = [doc]
+        else:
+            unpacked.append((name, doc))
+            continue
+        unpacked.extend(('event', event) for event in events)
+    # Events may be regrouped by descriptor on the way through, so compare
+    # each run of consecutive Events in time order.
+    regrouped = []
+    for is_event, group in itertools.groupby(
+            unpacked, key=lambda item: item[0] == 'event'):
+        group = list(group)
+        if is_event:
+            group.sort(key=lambda item: item[1]['time'])
+        regrouped.extend(group)
+    # Round-trip through JSON to compare numpy arrays with lists.
+    return [json.loads(json.dumps(item, cls=NumpyEncoder))
+            for item in regrouped]
 
 
 def test_export(tmp_path, example_data):
@@ -13,6 +67,13 @@ def test_export(tmp_path, example_data):
     # ... and read back the data to check that it looks right.
 
 
+def test_round_trip(tmp_path, example_data):
+    documents = example_data()
+    artifacts = export(documents, tmp_path)
+    filepath, = artifacts['all']
+    assert _normalize(_read(filepath)) == _normalize(documents)
+
+
 def test_file_prefix_formatting(file_prefix_list, example_data, tmp_path):
     '''Runs a test of the ``file_prefix`` formatting.
     ..note::
@@ -34,3 +95,449 @@ def test_file_prefix_formatting(file_prefix_list, example_data, tmp_path):
         unique_actual = set(str(artifact).split('/')[-1].partition('-')[0]
                             for artifact in artifacts['all'])
         assert unique_actual == set([templated_file_prefix])
+
+
+def test_artifacts_read_only(tmp_path):
+    run = event_model.compose_run()
+    documents = [('start', run.start_doc), ('stop', run.compose_stop())]
+    artifacts = export(documents, tmp_path)
+    with pytest.raises(TypeError):
+        artifacts['all'] = []
+
+
+def test_packer_kwargs(tmp_path):
+    # autoreset is reserved by the Serializer; other arguments reach the
+    # Packer.
+    run = event_model.compose_run()
+    documents = [('start', run.start_doc), ('stop', run.compose_stop())]
+    artifacts = export(documents, tmp_path, autoreset=True,
+                       use_single_float=True)
+    filepath, = artifacts['all']
+    (_, start), (_, stop) = _read(filepath)
+    assert start['uid'] == run.start_doc['uid']
+    assert stop['time'] == pytest.approx(documents[1][1]['time'], rel=1e-6)
+    assert stop['time'] != documents[1][1]['time']
+
+
+def test_batch_size(tmp_path, example_data):
+    documents = example_data()
+    artifacts = export(documents, tmp_path, batch_size=3)
+    filepath, = artifacts['all']
+    assert _normalize(_read(filepath)) == _normalize(documents)
+
+
+def test_batch_size_merges_pages(tmp_path):
+    run = event_model.compose_run()
+    desc = run.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'dtype': 'number', 'shape': [], 'source': 'x'}})
+    documents = [('start', run.start_doc), ('descriptor', desc.descriptor_doc)]
+    for i in range(7):
+        documents.append(('event_page', event_model.pack_event_page(
+            desc.compose_event(data={'x': i}, timestamps={'x': i}))))
+    documents.append(('stop', run.compose_stop()))
+    artifacts = export(documents, tmp_path, batch_size=3)
+    filepath, = artifacts['all']
+    actual = _read(filepath)
+    assert [name for name, _ in actual] == [
+        'start', 'descriptor', 'event_page', 'event_page', 'event_page',
+        'stop']
+    assert [doc['data']['x'] for name, doc in actual
+            if name == 'event_page'] == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_batch_size_pages_without_filled(tmp_path):
+    run = event_model.compose_run()
+    desc = run.compose_descriptor(
+        name='primary',
+        data_keys={'x': {'dtype': 'number', 'shape': [], 'source': 'x'}})
+    documents = [('start', run.start_doc), ('descriptor', desc.descriptor_doc)]
+    for i in range(7):
+        page = event_model.pack_event_page(
+            desc.compose_event(data={'x': i}, timestamps={'x': i}))
+        if i < 3:
+            # 'filled' is optional in an EventPage.
+            del page['filled']
+        documents.append(('event_page', page))
+    documents.append(('stop', run.compose_stop()))
+    artifacts = export(documents, tmp_path, batch_size=2)
+    filepath, = artifacts['all']
+    pages = [doc for name, doc in _read(filepath) if name == 'event_page']
+    assert [page['data']['x'] for page in pages] == [
+        [0], [1], [2], [3, 4], [5, 6]]
+    assert ['filled' in page for page in pages] == [
+        False, False, False, True, True]
+
+
+@pytest.mark.parametrize('file_prefix', [
+    'plain-', '{{literal}}-', '{start[uid]}', 'scan_{start[uid]}-',
+    '{start[time]:.0f}-{start[uid]!r:.8}-', '{start[uid]:>{start[width]}}',
+])
+def test_file_prefix_templates(tmp_path, file_prefix):
+    run = event_model.compose_run(metadata={'width': 40})
+    documents = [('start', run.start_doc), ('stop', run.compose_stop())]
+    artifacts = export(documents, tmp_path, file_prefix=file_prefix)
+    filepath, = artifacts['all']
+    expected = file_prefix.format(start=run.start_doc)
+    assert filepath.name == f'{expected}.msgpack'
+
+
+def _image_run(shape):
+    "Make a run whose EventPages carry images of the given shape."
+    run = event_model.compose_run()
+    desc = run.compose_descriptor(
+        name='primary',
+        data_keys={'img': {'dtype': 'array', 'shape': list(shape),
+                           'dtype_numpy': '<f8', 'source': 'img'},
+                   'img_t': {'dtype': 'array', 'shape': list(shape)[::-1],
+                             'dtype_numpy': '<f8', 'source': 'img_t'},
+                   'x': {'dtype': 'number', 'shape': [], 'source': 'x'},
+                   'y': {'dtype': 'number', 'shape': [],
+                         'dtype_numpy': '<f8', 'source': 'y'}})
+    images = [np.random.random(shape) for i in range(3)]
+    # img_t holds non-contiguous views.
+    events = [desc.compose_event(data={'img': image, 'img_t': image.T,
+                                       'x': i, 'y': i / 3},
+                                 timestamps={'img': i, 'img_t': i, 'x': i,
+                                             'y': i})
+              for i, image in enumerate(images)]
+    # One page holds a list of images, the other a stacked (and
+    # non-contiguous) array of images.
+    list_page = event_model.pack_event_page(*events)
+    stacked_page = event_model.pack_event_page(*events)
+    stacked_page['data']['img'] = np.stack(
+        stacked_page['data']['img'], axis=-1).swapaxes(0, -1)
+    return [('start', run.start_doc), ('descriptor', desc.descriptor_doc),
+            ('event_page', list_page), ('event_page', stacked_page),
+            ('stop', run.compose_stop())]
+
+
+@pytest.mark.parametrize('shape', [(3, 4), (400, 500)])
+@pytest.mark.parametrize('in_memory', [False, True])
+@pytest.mark.parametrize('workers', [None, 2])
+@pytest.mark.parametrize('async_writes', [False, True])
+def test_large_arrays(tmp_path, shape, in_memory, workers, async_writes):
+    documents = _image_run(shape)
+    if in_memory:
+        artifacts = export(documents, suitcase.utils.MemoryBuffersManager(),
+                           workers=workers, async_writes=async_writes)
+        buffer, = artifacts['all']
+        actual = buffer.getvalue()
+    else:
+        artifacts = export(documents, tmp_path, workers=workers,
+                           async_writes=async_writes)
+        filepath, = artifacts['all']
+        with open(filepath, 'rb') as file:
+            actual = file.read()
+    # The output is byte-for-byte what msgpack_numpy would have produced.
+    expected = b''.join(msgpack.packb(item, default=msgpack_numpy.encode,
+                                      use_bin_type=True)
+                        for item in documents)
+    assert actual == expected
+
+
+@pytest.mark.parametrize('flush, expected', [
+    (False, [0, 0, 0]),
+    ('boundary', [1, 2, 2]),
+    (True, [1, 2, 3]),
+])
+def test_flush(tmp_path, flush, expected):
+    # Count the documents readable from the file as each one is written.
+    documents = _image_run((3, 4))[:3]
+    readable = []
+    with Serializer(tmp_path, flush=flush) as serializer:
+        for name, doc in documents:
+            serializer(name, doc)
+            filepath, = serializer.artifacts['all']
+            readable.append(len(_read(filepath)))
+    assert readable == expected
+
+
+@pytest.mark.parametrize('buffer_size, written_early', [
+    (1 << 16, False),
+    (64, True),
+])
+def test_buffer_size(tmp_path, buffer_size, written_early):
+    # Without flush, documents reach the file only when the buffer fills up
+    # or the file is closed.
+    documents = _image_run((3, 4))[:-1]
+    with Serializer(tmp_path, buffer_size=buffer_size) as serializer:
+        for name, doc in documents:
+            serializer(name, doc)
+        filepath, = serializer.artifacts['all']
+        assert (filepath.stat().st_size > 0) == written_early
+    assert len(_read(filepath)) == len(documents)
+
+
+def test_subclass_calls_super(tmp_path):
+    seen = []
+
+    class Recorder(Serializer):
+        def descriptor(self, doc):
+            seen.append('descriptor')
+            return super().descriptor(doc)
+
+        def event_page(self, doc):
+            seen.append('event_page')
+            return super().event_page(doc)
+
+    documents = _image_run((3, 4))
+    with Recorder(tmp_path) as serializer:
+        for name, doc in documents:
+            serializer(name, doc)
+    filepath, = serializer.artifacts['all']
+    assert seen == ['descriptor', 'event_page', 'event_page']
+    assert [name for name, _ in _read(filepath)] == [
+        name for name, _ in documents]
+
+
+class _RawBuffer(io.RawIOBase):
+    "An unbuffered, in-memory handle with no file descriptor."
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return memoryview(data).nbytes
+
+
+class _RawManager:
+    def __init__(self):
+        self.handle = _RawBuffer()
+
+    @property
+    def artifacts(self):
+        return {'all': [self.handle]}
+
+    def open(self, label, postfix, mode):
+        return self.handle
+
+    def close(self):
+        self.handle.close()
+
+
+def test_raw_handle_manager(tmp_path):
+    documents = _image_run((400, 500))
+    manager = _RawManager()
+    export(documents, manager)
+    artifacts = export(documents, tmp_path)
+    filepath, = artifacts['all']
+    with open(filepath, 'rb') as file:
+        expected = file.read()
+    assert bytes(manager.handle.data) == expected
+
+
+class _ListHandle:
+    "A handle that keeps the buffers it is given rather than copying them."
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        return memoryview(data).nbytes
+
+    def flush(self):
+        pass
+
+
+class _ListManager(_RawManager):
+    def __init__(self):
+        self.handle = _ListHandle()
+
+    def close(self):
+        pass
+
+
+def test_handle_keeps_buffers(tmp_path):
+    documents = _image_run((3, 4))
+    manager = _ListManager()
+    export(documents, manager)
+    artifacts = export(documents, tmp_path)
+    filepath, = artifacts['all']
+    with open(filepath, 'rb') as file:
+        expected = file.read()
+    assert b''.join(manager.handle.chunks) == expected
+
+
+def test_zstd_compression(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    documents = _image_run((400, 500))
+    artifacts = export(documents, tmp_path / 'zstd', compression='zstd')
+    filepath, = artifacts['all']
+    assert filepath.name.endswith('.msgpack.zst')
+    with open(filepath, 'rb') as file:
+        actual = zstandard.ZstdDecompressor().stream_reader(file).read()
+    artifacts = export(documents, tmp_path / 'plain')
+    filepath, = artifacts['all']
+    with open(filepath, 'rb') as file:
+        expected = file.read()
+    assert actual == expected
+
+
+@pytest.mark.parametrize('module, match', [
+    (None, 'requires the zstandard package'),
+    (types.SimpleNamespace(__version__='0.14.1'), 'zstandard >= 0.15'),
+])
+def test_zstd_missing(tmp_path, monkeypatch, module, match):
+    monkeypatch.setitem(sys.modules, 'zstandard', module)
+    with pytest.raises(ImportError, match=match):
+        Serializer(tmp_path, compression='zstd')
+
+
+def test_dtype_downcast(tmp_path):
+    documents = _image_run((400, 500))
+    artifacts = export(documents, tmp_path,
+                       dtype_downcast={'default': 'float32', 'img_t': None})
+    filepath, = artifacts['all']
+    _, (_, descriptor), (_, list_page), (_, stacked_page), _ = _read(filepath)
+    data_keys = descriptor['data_keys']
+    assert data_keys['img']['dtype_downcast'] == 'float32'
+    assert data_keys['img']['dtype_numpy'] == '<f4'
+    # Scalars are left as they are, and img_t is kept at full precision.
+    assert 'dtype_downcast' not in data_keys['x']
+    assert 'dtype_downcast' not in data_keys['y']
+    assert data_keys['y']['dtype_numpy'] == '<f8'
+    assert 'dtype_downcast' not in data_keys['img_t']
+    assert data_keys['img_t']['dtype_numpy'] == '<f8'
+    actual = stacked_page['data']
+    expected = documents[3][1]['data']
+    assert actual['img'].dtype == np.float32
+    assert np.array_equal(actual['img'], expected['img'].astype(np.float32))
+    assert [type(y) for y in actual['y']] == [float] * 3
+    assert actual['y'] == expected['y']
+    assert actual['x'] == expected['x']
+    assert np.array_equal(actual['img_t'], expected['img_t'])
+    # Arrays inside a list column are converted too.
+    assert [img.dtype for img in list_page['data']['img']] == [np.float32] * 3
+    # The documents passed in are not modified.
+    assert 'dtype_downcast' not in documents[1][1]['data_keys']['img']
+
+
+@pytest.mark.parametrize('dtype', ['int32', 'float64', 'complex64'])
+def test_dtype_downcast_rejects(tmp_path, dtype):
+    with pytest.raises(ValueError):
+        Serializer(tmp_path, dtype_downcast={'default': dtype})
+
+
+@pytest.mark.parametrize('buffer_size', [4096, 1 << 20])
+def test_direct_io(tmp_path, buffer_size):
+    documents = _image_run((400, 500))
+    try:
+        artifacts = export(documents, tmp_path / 'direct', direct_io=True,
+                           buffer_size=buffer_size)
+    except (ValueError, OSError) as err:
+        pytest.skip(f"O_DIRECT is not available here: {err}")
+    filepath, = artifacts['all']
+    with open(filepath, 'rb') as file:
+        actual = file.read()
+    artifacts = export(documents, tmp_path / 'plain')
+    filepath, = artifacts['all']
+    with open(filepath, 'rb') as file:
+        expected = file.read()
+    assert actual == expected
+
+
+def _direct_file(path):
+    if not hasattr(os, 'O_DIRECT'):
+        pytest.skip("O_DIRECT is not available here")
+    try:
+        return suitcase.msgpack._DirectFile(path, 4096)
+    except OSError as err:
+        pytest.skip(f"O_DIRECT is not available here: {err}")
+
+
+def _is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+def test_direct_io_close_releases_on_error(tmp_path, monkeypatch):
+    file = _direct_file(tmp_path / 'file')
+    fd = file._fd
+    file.write(b'partial block')
+
+    def write(fd, data):
+        raise OSError("disk on fire")
+
+    monkeypatch.setattr(os, 'write', write)
+    with pytest.raises(OSError, match='disk on fire'):
+        file.close()
+    assert file.closed
+    assert file._mmap.closed
+    assert not _is_open(fd)
+
+
+def test_direct_io_init_releases_on_error(tmp_path, monkeypatch):
+    _direct_file(tmp_path / 'probe').close()
+    opened = []
+
+    def os_open(*args, **kwargs):
+        opened.append(real_open(*args, **kwargs))
+        return opened[-1]
+
+    def mmap_(*args, **kwargs):
+        raise OSError("out of memory")
+
+    real_open = os.open
+    monkeypatch.setattr(os, 'open', os_open)
+    monkeypatch.setattr(mmap, 'mmap', mmap_)
+    with pytest.raises(OSError, match='out of memory'):
+        suitcase.msgpack._DirectFile(tmp_path / 'file', 4096)
+    fd, = opened
+    assert not _is_open(fd)
+
+
+def test_write_raw(tmp_path):
+    documents = _image_run((400, 500))
+    with Serializer(tmp_path / 'raw') as serializer:
+        for name, doc in documents:
+            serializer.write_raw(name, msgpack.packb(
+                (name, doc), default=msgpack_numpy.encode, use_bin_type=True))
+    filepath, = serializer.artifacts['all']
+    with open(filepath, 'rb') as file:
+        actual = file.read()
+    artifacts = export(documents, tmp_path / 'encoded')
+    filepath, = artifacts['all']
+    with open(filepath, 'rb') as file:
+        expected = file.read()
+    assert actual == expected
+
+
+class _BrokenFile:
+    def write(self, data):
+        raise OSError("disk full")
+
+    def flush(self):
+        pass
+
+
+class _BrokenManager:
+    artifacts = {}
+
+    def open(self, label, postfix, mode):
+        return _BrokenFile()
+
+    def close(self):
+        pass
+
+
+def test_async_writes_error():
+    documents = _image_run((3, 4))
+    with pytest.raises(OSError, match="disk full"):
+        export(documents, _BrokenManager(), async_writes=True)
+
+
+def test_async_writes_unused_serializer_is_collected(tmp_path):
+    threads = threading.active_count()
+    serializer = Serializer(tmp_path, async_writes=True)
+    ref = weakref.ref(serializer)
+    del serializer
+    gc.collect()
+    assert ref() is None
+    assert threading.active_count() == threads